@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+# #
+# Copyright 2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# All rights reserved.
+#
+# #
+"""
+Benchmark the user, vo and project information modes of dshowq.determine_target_information.
+
+The LDAP is replaced by an in-memory directory that counts the queries, so the benchmark measures the work
+done by dshowq and the number of LDAP round trips, not the LDAP server. For each mode the time to determine
+the information, the number and size of the distinct parts that are kept in memory, the time to digest and
+to merge the payloads of all users and the (estimated) total size of the pickles to store are reported.
+
+Usage: python benchmarks/bench_information_modes.py [users] [active users] [jobs] [projects]
+"""
+import cPickle
+import random
+import sys
+import time
+
+from stubs import load_script
+
+VO_SIZE = 50
+# fraction of the jobs that are not charged to a project
+UNCHARGED_JOBS = 0.05
+DEFAULT_VO = 'gvo00012'
+
+
+class FakeLdapFilter(object):
+    """Filter that keeps the attribute=value terms it was built from, combined with |."""
+
+    def __init__(self, text=None, terms=None):
+        if terms is None:
+            terms = [tuple(text.split('=', 1))]
+        self.terms = terms
+
+    def __or__(self, other):
+        return FakeLdapFilter(terms=self.terms + other.terms)
+
+
+def fake_institute_filter(institute):
+    return FakeLdapFilter(terms=[('institute', institute)])
+
+
+class FakeEntry(object):
+    """Entry in the fake directory, the lookups of every subclass are counted."""
+
+    entries = []
+    queries = 0
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    @classmethod
+    def lookup(cls, ldap_filter):
+        FakeEntry.queries += 1
+        if ldap_filter.terms[0][0] == 'institute':
+            return list(cls.entries)
+        values = set([value for (_, value) in ldap_filter.terms])
+        return [e for e in cls.entries if e.cn in values]
+
+
+class FakeLdapUser(FakeEntry):
+    entries = []
+
+
+class FakeLdapGroup(FakeEntry):
+    entries = []
+
+
+def make_directory(users, projects, rng):
+    """Fill the fake directory: every user is in a single VO and in one or two projects."""
+    uids = ['vsc%05d' % (i) for i in range(users)]
+    FakeLdapUser.entries = [FakeEntry(cn=uid, user_id=uid, gecos="User %s" % (uid)) for uid in uids]
+
+    groups = []
+    for (idx, start) in enumerate(range(0, users, VO_SIZE)):
+        gid = idx == 0 and DEFAULT_VO or 'gvo%05d' % (idx + 100)
+        groups.append(FakeEntry(cn=gid, group_id=gid, memberUid=uids[start:start + VO_SIZE]))
+
+    project_members = dict([('2013_%03d' % (i), []) for i in range(projects)])
+    user_projects = {}
+    for uid in uids:
+        user_projects[uid] = rng.sample(sorted(project_members), rng.choice([1, 1, 1, 2]))
+        for project in user_projects[uid]:
+            project_members[project].append(uid)
+    groups.extend([FakeEntry(cn=p, group_id=p, memberUid=m) for (p, m) in project_members.items()])
+    FakeLdapGroup.entries = groups
+
+    return (uids, user_projects)
+
+
+def make_queue_information(uids, user_projects, active, jobs, rng):
+    """Spread the jobs over the active users, charged to one of their projects (a few are not charged)."""
+    active_users = rng.sample(uids, active)
+    queue_information = {}
+    for i in range(jobs):
+        user = active_users[i % active]
+        job = {'DRMJID': '%d.master' % (i), 'ReqProcs': rng.choice([1, 8, 16])}
+        if rng.random() >= UNCHARGED_JOBS:
+            job['Account'] = rng.choice(user_projects[user])
+        jobtype = rng.choice(['Running', 'Idle', 'Blocked'])
+        queue_information.setdefault(user, {}).setdefault('cluster', {}).setdefault(jobtype, []).append(job)
+    return queue_information
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:]]
+    (users, active, jobs, projects) = (args + [20000, 10000, 50000, 200][len(args):])[:4]
+    rng = random.Random(42)
+
+    dshowq = load_script('dshowq')
+    from master_scripts import ldap_lookup
+    from master_scripts.store import digest_pickle_contents
+    ldap_lookup.LdapFilter = FakeLdapFilter
+    dshowq.InstituteFilter = fake_institute_filter
+    dshowq.VscLdapUser = FakeLdapUser
+    dshowq.VscLdapGroup = FakeLdapGroup
+    dshowq.LdapQuery = lambda configuration: None
+    dshowq.VscConfiguration = lambda: None
+
+    (uids, user_projects) = make_directory(users, projects, rng)
+    queue_information = make_queue_information(uids, user_projects, active, jobs, rng)
+    active_users = queue_information.keys()
+
+    print "%d users in LDAP, %d active users, %d jobs, %d projects" % (users, len(active_users), jobs, projects)
+    print "%8s %8s %8s %8s %8s %10s %10s %10s %12s" % ("mode", "run (s)", "queries", "targets", "parts",
+                                                       "kept (MB)", "digest (s)", "merge (s)", "stored (MB)")
+    for mode in ['user', 'vo', 'project']:
+        FakeEntry.queries = 0
+        start = time.time()
+        (target_users, target_queue_parts, user_map) = dshowq.determine_target_information(mode,
+                                                                                           active_users,
+                                                                                           queue_information)
+        if mode == 'vo':
+            # as in dshowq.main, every member gets the name map of its VO
+            user_map = dict([(uid, vo_user_map) for vo_user_map in user_map.values() for uid in vo_user_map])
+        elapsed = time.time() - start
+
+        # the parts are kept in memory for the whole run, they are only merged per user when storing
+        parts = dict([(id(part), part) for user in target_users for part in target_queue_parts[user]])
+        kept = sum([len(cPickle.dumps(part)) for part in parts.values()])
+
+        start = time.time()
+        contents = dict([(user, tuple(target_queue_parts[user]) + (user_map[user],)) for user in target_users])
+        digests = digest_pickle_contents(contents)
+        digest_elapsed = time.time() - start
+
+        start = time.time()
+        for user in target_users:
+            dshowq.merge_queue_information(target_queue_parts[user])
+        merge_elapsed = time.time() - start
+        stored = sum([size for (_, size) in digests.values()])
+
+        print "%8s %8.3f %8d %8d %8d %10.1f %10.3f %10.3f %12.1f" % (mode, elapsed, FakeEntry.queries,
+                                                                   len(target_users), len(parts),
+                                                                   kept / 1024.0 / 1024, digest_elapsed,
+                                                                   merge_elapsed, stored / 1024.0 / 1024)
+
+if __name__ == '__main__':
+    main()
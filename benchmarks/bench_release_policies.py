@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+# #
+# Copyright 2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# All rights reserved.
+#
+# #
+"""
+Benchmark the cost per held job in release_jobholds.process_hold for a growing number of release policy rules.
+
+Moab and the release history cache are replaced by fakes, so only the work done by the script is measured.
+The policies are compiled once, so the cost per job should not depend on the number of rules.
+
+Usage: python benchmarks/bench_release_policies.py [jobs] [repeats]
+"""
+import copy
+import sys
+import time
+
+from stubs import MemoryCache, load_script
+
+CLUSTERS = ['cluster%d' % (i) for i in range(4)]
+USERS = 1000
+RULES = [1, 10, 100, 1000]
+
+
+class FakeShowq(object):
+    """Showq that returns the next prepared queue information."""
+
+    queue_information = []
+
+    def __init__(self, clusters, cache_pickle=False):
+        self.clusters = clusters
+
+    def get_moab_command_information(self):
+        return (FakeShowq.queue_information.pop(), self.clusters.keys(), [])
+
+
+class FakeMoabCommand(object):
+    """MoabCommand that never releases anything, so process_hold can run without dry_run and keep its history."""
+
+    def __init__(self, cache_pickle=False, dry_run=False):
+        self.clusters = {}
+        self.dry_run = True
+
+    def _run_moab_command(self, cmd, cluster, args):
+        pass
+
+
+def make_queue_information(jobs):
+    """Spread the given number of held jobs over the users and clusters."""
+    queue_information = {}
+    for i in range(jobs):
+        user = 'vsc%05d' % (i % USERS)
+        cluster = CLUSTERS[i % len(CLUSTERS)]
+        job = {'DRMJID': '%d.%s' % (i, cluster), 'Account': 'project%d' % (i % 100), 'ReqProcs': 1}
+        queue_information.setdefault(user, {}).setdefault(cluster, {}).setdefault('BatchHold', []).append(job)
+    return queue_information
+
+
+def main():
+    jobs = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    repeats = len(sys.argv) > 2 and int(sys.argv[2]) or 3
+
+    release_jobholds = load_script('release_jobholds')
+    release_jobholds.Showq = FakeShowq
+    release_jobholds.MoabCommand = FakeMoabCommand
+
+    clusters = dict([(c, {'master': c, 'spath': '/bin/true', 'mpath': '/bin/true'}) for c in CLUSTERS])
+    queue_information = make_queue_information(jobs)
+
+    print "%d held jobs, %d users, %d clusters, best of %d runs" % (jobs, USERS, len(CLUSTERS), repeats)
+    print "%8s %12s %14s" % ("rules", "run (s)", "per job (us)")
+    for rules in RULES:
+        policy = ','.join(["Hold%d:30:0" % (i) for i in range(rules - 1)] + ['BatchHold:30:0'])
+        policies = release_jobholds.compile_release_policies(dict.fromkeys(CLUSTERS), policy, 30)
+
+        # the first run releases every job, the measured runs find all of them backing off
+        cache = MemoryCache()
+        release_jobholds.FileCache = lambda filename: cache
+        FakeShowq.queue_information = [copy.deepcopy(queue_information) for _ in range(repeats + 1)]
+        release_jobholds.process_hold(clusters, policies)
+
+        best = None
+        for _ in range(repeats):
+            start = time.time()
+            release_jobholds.process_hold(clusters, policies)
+            elapsed = time.time() - start
+            best = best is None and elapsed or min(best, elapsed)
+
+        print "%8d %12.3f %14.2f" % (rules, best, best / jobs * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: latin-1 -*-
+# #
+# Copyright 2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# All rights reserved.
+#
+# #
+"""
+Load the master scripts for the benchmarks, without the vsc libraries.
+
+The vsc modules the scripts import are replaced by stub modules, the benchmarks then replace what they
+actually use (Moab, LDAP, caches) with fakes that generate synthetic data.
+"""
+import imp
+import logging
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_MODULES = [
+    'vsc',
+    'vsc.administration',
+    'vsc.administration.user',
+    'vsc.jobs',
+    'vsc.jobs.moab',
+    'vsc.jobs.moab.checkjob',
+    'vsc.jobs.moab.internal',
+    'vsc.jobs.moab.showq',
+    'vsc.ldap',
+    'vsc.ldap.configuration',
+    'vsc.ldap.entities',
+    'vsc.ldap.filters',
+    'vsc.ldap.utils',
+    'vsc.utils',
+    'vsc.utils.availability',
+    'vsc.utils.cache',
+    'vsc.utils.fancylogger',
+    'vsc.utils.fs_store',
+    'vsc.utils.generaloption',
+    'vsc.utils.lock',
+    'vsc.utils.mail',
+    'vsc.utils.nagios',
+    'vsc.utils.timestamp_pid_lockfile',
+    'PBSQuery',
+]
+
+
+class StubModule(types.ModuleType):
+    """Module that provides a placeholder for any name that is imported from it."""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        stub = type(name, (Exception,), {})
+        setattr(self, name, stub)
+        return stub
+
+
+def install_stubs():
+    """Put the stub modules in place of the vsc libraries and make the shared code importable."""
+    for name in STUB_MODULES:
+        if name not in sys.modules:
+            sys.modules[name] = StubModule(name)
+
+    fancylogger = sys.modules['vsc.utils.fancylogger']
+    fancylogger.getLogger = lambda name=None, fname=True: logging.getLogger(name)
+    fancylogger.logToScreen = lambda *args, **kwargs: None
+    fancylogger.setLogLevelInfo = lambda: None
+    sys.modules['vsc.utils'].fancylogger = fancylogger
+
+    logging.basicConfig(level=logging.ERROR)
+
+    lib = os.path.join(ROOT, 'lib')
+    if lib not in sys.path:
+        sys.path.insert(0, lib)
+
+
+def load_script(name):
+    """Load one of the scripts in bin as a module."""
+    install_stubs()
+    return imp.load_source(name, os.path.join(ROOT, 'bin', "%s.py" % (name)))
+
+
+class MemoryCache(object):
+    """In-memory replacement for vsc.utils.cache.FileCache."""
+
+    def __init__(self, filename=None, data=None):
+        self.data = data or {}
+
+    def load(self, key):
+        return self.data.get(key)
+
+    def update(self, key, data, threshold):
+        self.data[key] = (0, data)
+
+    def close(self):
+        pass
@@ -20,6 +20,9 @@ import os
 import sys
 import time
 
+from master_scripts.ha import HA_OPTIONS, export_state, import_state
+from master_scripts.profiler import PROFILE_OPTIONS, RunProfiler
+from master_scripts.store import merge_last_good_snapshots, store_json, store_pickle_files
 from vsc.administration.user import cluster_user_pickle_location_map, cluster_user_pickle_store_map
 from vsc.jobs.moab.checkjob import Checkjob, CheckjobInfo
 from vsc.ldap.configuration import VscConfiguration
@@ -39,6 +42,13 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 30 * 60  # 30 minutes
 
 DCHECKJOB_LOCK_FILE = '/var/run/dcheckjob_tpid.lock'
 
+DCHECKJOB_SNAPSHOT_FILE = '/var/cache/dcheckjob.snapshot.pickle'
+DCHECKJOB_SNAPSHOT_MAX_AGE = 2 * 60 * 60  # 2 hours
+DCHECKJOB_STALEINFO_FILE = '/var/cache/dcheckjob.staleinfo.json'
+
+DCHECKJOB_STORE_HISTORY_FILE = '/var/cache/dcheckjob.history.pickle'
+
+
 logger = fancylogger.getLogger(__name__)
 fancylogger.logToScreen(True)
 fancylogger.setLogLevelInfo()
@@ -70,11 +80,28 @@ def main():
         'nagios_check_filename': ('filename of where the nagios check data is stored', str, 'store', NAGIOS_CHECK_FILENAME),
         'nagios_check_interval_threshold': ('threshold of nagios checks timing out', None, 'store', NAGIOS_CHECK_INTERVAL_THRESHOLD),
         'hosts': ('the hosts/clusters that should be contacted for job information', None, 'extend', []),
-        'location': ('the location for storing the pickle file: home, scratch', str, 'store', 'home'),
+        'location': ('the location(s) for storing the pickle file: home, scratch', 'strlist', 'store', ['home']),
+        'snapshot_filename': ('filename of where the last good information per host is stored', str, 'store',
+                              DCHECKJOB_SNAPSHOT_FILE),
+        'snapshot_max_age': ('maximal age (in seconds) of the last good information to use for failed hosts', int,
+                             'store', DCHECKJOB_SNAPSHOT_MAX_AGE),
+        'staleinfo_filename': ('filename of where the hosts for which older information was used are published', str,
+                               'store', DCHECKJOB_STALEINFO_FILE),
+        'max_writes_per_second': ('maximal number of pickle files stored per second for each location (0 is unlimited)',
+                                  int, 'store', 0),
+        'max_bytes_per_second': ('maximal number of bytes stored per second for each location (0 is unlimited)',
+                                 int, 'store', 0),
+        'store_time_budget': ('maximal time (in seconds) to spend storing for each location, the users that do not fit '
+                              'are deferred to the next run (0 is unlimited)', int, 'store', 0),
+        'store_history_filename': ('filename of where the digests of the stored information are kept', str, 'store',
+                                   DCHECKJOB_STORE_HISTORY_FILE),
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
     }
 
+    options.update(HA_OPTIONS)
+    options.update(PROFILE_OPTIONS)
+
     opts = simple_option(options)
 
     if opts.options.debug:
@@ -88,8 +115,14 @@ def main():
         nagios_reporter.report_and_exit()
         sys.exit(0)  # not reached
 
+    state_files = [
+        opts.options.snapshot_filename,
+        opts.options.store_history_filename,
+    ]
+
     if not proceed_on_ha_service(opts.options.ha):
         logger.warning("Not running on the target host in the HA setup. Stopping.")
+        import_state(state_files, opts.options.ha_state_dir, opts.options.dry_run)
         nagios_reporter.cache(NAGIOS_EXIT_WARNING,
                         NagiosResult("Not running on the HA master."))
         sys.exit(NAGIOS_EXIT_WARNING)
@@ -99,8 +132,13 @@ def main():
 
     logger.info("Starting dcheckjob")
 
+    profiler = RunProfiler(NAGIOS_HEADER, opts.options.profile, opts.options.profile_dir, opts.options.profile_keep)
+    profiler.start('ldap')
+
     LdapQuery(VscConfiguration())
 
+    profiler.start('collect')
+
     clusters = {}
     for host in opts.options.hosts:
         master = opts.configfile_parser.get(host, "master")
@@ -115,44 +153,54 @@ def main():
     (job_information, reported_hosts, failed_hosts) = checkjob.get_moab_command_information()
     timeinfo = time.time()
 
+    # avoid users losing the jobs on a cluster that did not respond this time
+    staleinfo = merge_last_good_snapshots(job_information,
+                                          reported_hosts,
+                                          failed_hosts,
+                                          opts.options.snapshot_filename,
+                                          opts.options.snapshot_max_age,
+                                          dry_run=opts.options.dry_run)
+    # published next to the user files, the format of the latter does not change
+    if not opts.options.dry_run:
+        try:
+            store_json(opts.options.staleinfo_filename, {'timeinfo': timeinfo, 'staleinfo': staleinfo})
+        except (IOError, OSError), err:
+            logger.error("Could not store the stale host information in %s: %s" %
+                         (opts.options.staleinfo_filename, err))
+
     active_users = job_information.keys()
 
     logger.debug("Active users: %s" % (active_users))
     logger.debug("Checkjob information: %s" % (job_information))
 
-    nagios_user_count = 0
-    nagios_no_store = 0
-
-    for user in active_users:
-        if not opts.options.dry_run:
-            try:
-                (path, store) = get_pickle_path(opts.options.location, user)
-                user_queue_information = CheckjobInfo({user: job_information[user]})
-                store(user, path, (timeinfo, user_queue_information))
-                nagios_user_count += 1
-            except (UserStorageError, FileStoreError, FileMoveError), _:
-                logger.error("Could not store pickle file for user %s" % (user))
-                nagios_no_store += 1
-        else:
-            logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user)[0]))
-            logger.debug("Dry run, queue information for user %s is %s" % (user, job_information[user]))
+    profiler.start('store')
+    store_stats = store_pickle_files(opts.options.location,
+                                     active_users,
+                                     get_pickle_path,
+                                     lambda user: (timeinfo, CheckjobInfo({user: job_information[user]})),
+                                     lambda user: job_information[user],
+                                     opts.options.store_history_filename,
+                                     opts.options.max_writes_per_second,
+                                     opts.options.max_bytes_per_second,
+                                     opts.options.store_time_budget,
+                                     opts.options.dry_run)
+
+    profiler.report()
+
+    export_state(state_files, opts.options.ha_state_dir, opts.options.dry_run)
 
     logger.info("Finished dcheckjobd")
 
+    nagios_results = dict(hosts=len(reported_hosts),
+                          hosts_critical=len(failed_hosts),
+                          hosts_stale=len(staleinfo),
+                          **store_stats)
+
     #FIXME: this still looks fugly
-    bork_result = NagiosResult("lock release failed",
-                               hosts=len(reported_hosts),
-                               hosts_critical=len(failed_hosts),
-                               stored=nagios_user_count,
-                               stored_critical=nagios_no_store)
+    bork_result = NagiosResult("lock release failed", **nagios_results)
     release_or_bork(lockfile, nagios_reporter, bork_result)
 
-    nagios_reporter.cache(NAGIOS_EXIT_OK,
-                          NagiosResult("run successful",
-                                       hosts=len(reported_hosts),
-                                       hosts_critical=len(failed_hosts),
-                                       stored=nagios_user_count,
-                                       stored_critical=nagios_no_store))
+    nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("run successful", **nagios_results))
 
     sys.exit(0)
 
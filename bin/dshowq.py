@@ -27,6 +27,10 @@ import time
 
 
 from vsc.utils import fancylogger
+from master_scripts.ha import HA_OPTIONS, export_state, import_state
+from master_scripts.ldap_lookup import ldap_batched_lookup
+from master_scripts.profiler import PROFILE_OPTIONS, RunProfiler
+from master_scripts.store import merge_last_good_snapshots, store_json, store_pickle_files
 from vsc.administration.user import cluster_user_pickle_store_map, cluster_user_pickle_location_map
 from vsc.utils.lock import lock_or_bork, release_or_bork
 from vsc.jobs.moab.showq import Showq
@@ -50,6 +54,15 @@ NAGIOS_REPORT_VALUES_TEMPLATE = "HR=%d, HU=%d, UC=%d, NS=%d"
 
 DSHOWQ_LOCK_FILE = '/var/run/dshowq_tpid.lock'
 
+DSHOWQ_SNAPSHOT_FILE = '/var/cache/dshowq.snapshot.pickle'
+DSHOWQ_SNAPSHOT_MAX_AGE = 60 * 60  # 1 hour
+DSHOWQ_STALEINFO_FILE = '/var/cache/dshowq.staleinfo.json'
+
+DSHOWQ_STORE_HISTORY_FILE = '/var/cache/dshowq.history.pickle'
+
+DSHOWQ_SUMMARY_FILE = '/var/cache/dshowq.summary.json'
+
+
 DEFAULT_VO = 'gvo00012'
 
 logger = fancylogger.getLogger(__name__)
@@ -57,6 +70,17 @@ fancylogger.logToScreen(True)
 fancylogger.setLogLevelInfo()
 
 
+def vo_ldap_filter():
+    """The LDAP filter for the VOs and their members of all institutes."""
+    return reduce(lambda f, g: f | g, [InstituteFilter(i) for i in ('antwerpen', 'brussel', 'gent', 'leuven')])
+
+
+def collect_vo_groups():
+    """Retrieve all VOs from the HPC LDAP, in a single query."""
+    LdapQuery(VscConfiguration())
+    return [g for g in VscLdapGroup.lookup(vo_ldap_filter()) if g.group_id.startswith('gvo')]
+
+
 def collect_vo_ldap(active_users):
     """Determine which active users are in the same VO.
 
@@ -69,11 +93,8 @@ def collect_vo_ldap(active_users):
 
     @return: dict with vo IDs as keys (default VO members are their own VO) and dicts mapping uid to gecos as values.
     """
-    LdapQuery(VscConfiguration())
-    ldap_filter = InstituteFilter('antwerpen') | InstituteFilter('brussel') | InstituteFilter('gent') | InstituteFilter('leuven')
-
-    vos = [g for g in VscLdapGroup.lookup(ldap_filter) if g.group_id.startswith('gvo')]
-    members = dict([(u.user_id, u) for u in VscLdapUser.lookup(ldap_filter)])
+    vos = collect_vo_groups()
+    members = dict([(u.user_id, u) for u in VscLdapUser.lookup(vo_ldap_filter())])
     user_to_vo_map = dict([(u, vo) for vo in vos for u in vo.memberUid])
 
     user_maps_per_vo = {}
@@ -93,7 +114,7 @@ def collect_vo_ldap(active_users):
                 name = members[user].gecos
                 user_maps_per_vo[user] = {user: name}
             else:
-                user_map = dict([(uid, members[uid].gecos) for uid in vo.memberUid and uid in active_users])
+                user_map = dict([(uid, members[uid].gecos) for uid in vo.memberUid if uid in active_users])
                 for uid in user_map:
                     found.add(uid)
                 user_maps_per_vo[vo.group_id] = user_map
@@ -103,23 +124,175 @@ def collect_vo_ldap(active_users):
     return (found, user_maps_per_vo)
 
 
+def collect_project_ldap(projects, owners):
+    """Determine the members of the given projects and the names of the given job owners.
+
+    @type projects: list of strings
+    @type owners: list of strings
+
+    @param projects: the projects (accounts) to which the current jobs are charged
+    @param owners: the users for which there currently are jobs
+
+    Only the given projects and users are looked up in the LDAP.
+
+    @return: tuple of (dict mapping project to its member uids, dict mapping owner uid to gecos)
+    """
+    LdapQuery(VscConfiguration())
+
+    members = dict([(g.group_id, g.memberUid) for g in ldap_batched_lookup(VscLdapGroup, 'cn', projects)])
+    names = dict([(u.user_id, u.gecos) for u in ldap_batched_lookup(VscLdapUser, 'cn', owners)])
+
+    return (members, names)
+
+
+def collect_user_vos(users):
+    """Determine the VO of each of the given users.
+
+    @type users: list of strings
+
+    @param users: the users for which there currently are jobs
+
+    The VOs are retrieved in a single LDAP query, regardless of the number of users.
+
+    @return: dict mapping uid to the VO ID, users that are not in a VO are left out.
+    """
+    users = set(users)
+    vos = collect_vo_groups()
+    return dict([(uid, vo.group_id) for vo in sorted(vos, key=lambda g: g.group_id)
+                 for uid in vo.memberUid if uid in users])
+
+
+def merge_queue_information(parts):
+    """Merge the queue information of several parts into a new dict, the parts are not modified.
+
+    @type parts: list of dicts of user -> {cluster -> {jobtype -> [jobs]}}
+
+    @return: the merged queue information, a (shallow) copy if there is a single part.
+    """
+    if len(parts) == 1:
+        return dict(parts[0])
+
+    merged = {}
+    for part in parts:
+        for (user, clusterdata) in part.items():
+            for (cluster, data) in clusterdata.items():
+                for (jobtype, jobs) in data.items():
+                    merged.setdefault(user, {}).setdefault(cluster, {}).setdefault(jobtype, []).extend(jobs)
+    return merged
+
+
+def determine_project_information(queue_information):
+    """Determine the information each member of a project gets to see: all jobs that are charged to the project.
+
+    @type queue_information: dict of user -> {cluster -> {jobtype -> [jobs]}}
+
+    The jobs are indexed per project in a single pass over the queue information, so the cost does not depend
+    on the size of the projects. Jobs that are not charged to a project are only shown to their owner, as a
+    personal part. The information of each project is computed once and shared by all its members: a user
+    gets the list of the parts it can see, which are only merged when the user's pickle file is stored. The
+    name map is shared by all users that see the same parts.
+
+    @return: tuple of (target users, dict of user -> list of parts of the queue information,
+                       dict of user -> {uid: gecos})
+    """
+    projects = {}
+    personal = {}
+    for (user, clusterdata) in queue_information.items():
+        for (cluster, data) in clusterdata.items():
+            for (jobtype, jobs) in data.items():
+                for job in jobs:
+                    project = job.get('Account')
+                    if project:
+                        project_information = projects.setdefault(project, {})
+                    else:
+                        project_information = personal.setdefault(user, {})
+                    project_information.setdefault(user, {}).setdefault(cluster, {}).setdefault(jobtype, []).append(job)
+
+    (members, names) = collect_project_ldap(projects.keys(), queue_information.keys())
+
+    user_parts = {}
+    for (project, project_information) in projects.items():
+        # owners always see their own jobs, even if the project is not known in the LDAP
+        project_members = set(members.get(project, [])) | set(project_information.keys())
+        for user in project_members:
+            user_parts.setdefault(user, []).append(project_information)
+        logger.debug("project %s has %d members and %d job owners" %
+                     (project, len(project_members), len(project_information)))
+    for (user, user_information) in personal.items():
+        user_parts.setdefault(user, []).append(user_information)
+
+    project_names = {}
+    user_map = {}
+    for (user, parts) in user_parts.items():
+        key = tuple(sorted([id(part) for part in parts]))
+        if key not in project_names:
+            project_names[key] = dict([(uid, names.get(uid, "")) for part in parts for uid in part])
+        user_map[user] = project_names[key]
+
+    return (user_parts.keys(), user_parts, user_map)
+
+
 def determine_target_information(information, active_users, queue_information):
-    """Determine for the given information type, what should be stored for which users."""
+    """Determine for the given information type, what should be stored for which users.
+
+    @return: tuple of (target users, dict of user -> list of parts of the queue information that are merged into
+             the user's pickle file, name map), see merge_queue_information
+    """
 
     if information == 'user':
         user_info = dict([(u, {u: ""}) for u in active_users])  # FIXME: faking it
-        return (active_users, dict([(user, {user: queue_information[user]}) for user in active_users]), user_info)
+        return (active_users, dict([(user, [{user: queue_information[user]}]) for user in active_users]), user_info)
     elif information == 'vo':
         (all_target_users, user_maps_per_vo) = collect_vo_ldap(active_users)
 
         target_queue_information = {}
         for vo in user_maps_per_vo.values():
             filtered_queue_information = dict([(user_id, queue_information[user_id]) for user_id in vo if user_id in queue_information])
-            target_queue_information.update(dict([(user_id, filtered_queue_information) for user_id in vo]))
+            target_queue_information.update(dict([(user_id, [filtered_queue_information]) for user_id in vo]))
 
         return (all_target_users, target_queue_information, user_maps_per_vo)
     elif information == 'project':
-        return (None, None, None)
+        return determine_project_information(queue_information)
+
+
+def summarise_queue_information(queue_information, user_to_vo=None):
+    """Count the jobs and cores per state, in total and by cluster, VO and user, in a single pass.
+
+    @type queue_information: dict of user -> {cluster -> {state -> [jobs]}}
+    @type user_to_vo: dict of user -> VO
+
+    @param user_to_vo: the VO of each user, if known. Users that have no VO are not counted in the VO summary.
+
+    @return: dict with the 'total', 'cluster', 'vo' and 'user' summaries, each of which maps (the cluster, VO or
+             user to) the state to a dict with the number of jobs and the number of cores.
+    """
+    summary = {
+        'total': {},
+        'cluster': {},
+        'vo': {},
+        'user': {},
+    }
+    if user_to_vo is None:
+        user_to_vo = {}
+
+    for (user, clusterdata) in queue_information.items():
+        vo = user_to_vo.get(user)
+        for (cluster, data) in clusterdata.items():
+            for (state, jobs) in data.items():
+                cores = sum([int(job.get('ReqProcs', 0)) for job in jobs])
+                counters = [
+                    summary['total'],
+                    summary['cluster'].setdefault(cluster, {}),
+                    summary['user'].setdefault(user, {}),
+                ]
+                if vo:
+                    counters.append(summary['vo'].setdefault(vo, {}))
+                for counter in counters:
+                    state_counter = counter.setdefault(state, {'jobs': 0, 'cores': 0})
+                    state_counter['jobs'] += len(jobs)
+                    state_counter['cores'] += cores
+
+    return summary
 
 
 def get_pickle_path(location, user_id):
@@ -148,11 +321,30 @@ def main():
         'nagios_check_interval_threshold': ('threshold of nagios checks timing out', None, 'store', NAGIOS_CHECK_INTERVAL_THRESHOLD),
         'hosts': ('the hosts/clusters that should be contacted for job information', None, 'extend', []),
         'information': ('the sort of information to store: user, vo, project', None, 'store', 'user'),
-        'location': ('the location for storing the pickle file: gengar, muk', str, 'store', 'gengar'),
+        'location': ('the location(s) for storing the pickle file: gengar, muk', 'strlist', 'store', ['gengar']),
+        'snapshot_filename': ('filename of where the last good information per host is stored', str, 'store',
+                              DSHOWQ_SNAPSHOT_FILE),
+        'snapshot_max_age': ('maximal age (in seconds) of the last good information to use for failed hosts', int,
+                             'store', DSHOWQ_SNAPSHOT_MAX_AGE),
+        'staleinfo_filename': ('filename of where the hosts for which older information was used are published', str,
+                               'store', DSHOWQ_STALEINFO_FILE),
+        'max_writes_per_second': ('maximal number of pickle files stored per second for each location (0 is unlimited)',
+                                  int, 'store', 0),
+        'max_bytes_per_second': ('maximal number of bytes stored per second for each location (0 is unlimited)',
+                                 int, 'store', 0),
+        'store_time_budget': ('maximal time (in seconds) to spend storing for each location, the users that do not fit '
+                              'are deferred to the next run (0 is unlimited)', int, 'store', 0),
+        'store_history_filename': ('filename of where the digests of the stored information are kept', str, 'store',
+                                   DSHOWQ_STORE_HISTORY_FILE),
+        'summary_filename': ('filename of where the summary of the queue information is published', str, 'store',
+                             DSHOWQ_SUMMARY_FILE),
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
     }
 
+    options.update(HA_OPTIONS)
+    options.update(PROFILE_OPTIONS)
+
     opts = simple_option(options)
 
     if opts.options.debug:
@@ -164,8 +356,15 @@ def main():
         nagios_reporter.report_and_exit()
         sys.exit(0)  # not reached
 
+    state_files = [
+        opts.options.snapshot_filename,
+        opts.options.store_history_filename,
+        opts.options.summary_filename,
+    ]
+
     if not proceed_on_ha_service(opts.options.ha):
         logger.warning("Not running on the target host in the HA setup. Stopping.")
+        import_state(state_files, opts.options.ha_state_dir, opts.options.dry_run)
         nagios_reporter.cache(NAGIOS_EXIT_WARNING,
                         NagiosResult("Not running on the HA master."))
         sys.exit(NAGIOS_EXIT_WARNING)
@@ -175,6 +374,9 @@ def main():
 
     logger.info("starting dshowq run")
 
+    profiler = RunProfiler(NAGIOS_HEADER, opts.options.profile, opts.options.profile_dir, opts.options.profile_keep)
+    profiler.start('collect')
+
     clusters = {}
     for host in opts.options.hosts:
         master = opts.configfile_parser.get(host, "master")
@@ -189,55 +391,102 @@ def main():
     (queue_information, reported_hosts, failed_hosts) = showq.get_moab_command_information()
     timeinfo = time.time()
 
+    # avoid users losing the jobs on a cluster that did not respond this time
+    staleinfo = merge_last_good_snapshots(queue_information,
+                                          reported_hosts,
+                                          failed_hosts,
+                                          opts.options.snapshot_filename,
+                                          opts.options.snapshot_max_age,
+                                          dry_run=opts.options.dry_run)
+    # published next to the user files, the format of the latter does not change
+    if not opts.options.dry_run:
+        try:
+            store_json(opts.options.staleinfo_filename, {'timeinfo': timeinfo, 'staleinfo': staleinfo})
+        except (IOError, OSError), err:
+            logger.error("Could not store the stale host information in %s: %s" %
+                         (opts.options.staleinfo_filename, err))
+
     active_users = queue_information.keys()
 
     logger.debug("Active users: %s" % (active_users))
     logger.debug("Queue information: %s" % (queue_information))
 
+    profiler.start('ldap')
+
     # We need to determine which users should get an updated pickle. This depends on
     # - the active user set
     # - the information we want to provide on the cluster(set) where this script runs
     # At the same time, we need to determine the job information each user gets to see
-    (target_users, target_queue_information, user_map) = determine_target_information(opts.options.information,
-                                                                                      active_users,
-                                                                                      queue_information)
-
-    nagios_user_count = 0
-    nagios_no_store = 0
+    (target_users, target_queue_parts, user_map) = determine_target_information(opts.options.information,
+                                                                                active_users,
+                                                                                queue_information)
 
     LdapQuery(VscConfiguration())
 
-    for user in target_users:
-        if not opts.options.dry_run:
-            try:
-                (path, store) = get_pickle_path(opts.options.location, user)
-                user_queue_information = target_queue_information[user]
-                user_queue_information['timeinfo'] = timeinfo
-                store(user, path, (user_queue_information, user_map[user]))
-                nagios_user_count += 1
-            except (UserStorageError, FileStoreError, FileMoveError), err:
-                logger.error("Could not store pickle file for user %s" % (user))
-                nagios_no_store += 1
-        else:
-            logger.info("Dry run, not actually storing data for user %s at path %s" % (user, get_pickle_path(opts.options.location, user)[0]))
-            logger.debug("Dry run, queue information for user %s is %s" % (user, target_queue_information[user]))
+    # for the summary, the VO of each user is known from the VO information, otherwise it is looked up
+    if opts.options.information == 'vo':
+        user_to_vo = {}
+        for (vo, vo_user_map) in user_map.items():
+            for uid in vo_user_map:
+                if vo.startswith('gvo'):
+                    user_to_vo[uid] = vo
+                else:
+                    user_to_vo[uid] = DEFAULT_VO
+        # the VO information is keyed by VO, each member gets the name map of its VO
+        user_map = dict([(uid, vo_user_map) for vo_user_map in user_map.values() for uid in vo_user_map])
+    else:
+        user_to_vo = collect_user_vos(active_users)
+
+    profiler.start('transform')
+
+    summary = summarise_queue_information(queue_information, user_to_vo)
+    summary['timeinfo'] = timeinfo
+    summary['staleinfo'] = staleinfo
+
+    profiler.start('store')
+
+    if not opts.options.dry_run:
+        try:
+            store_json(opts.options.summary_filename, summary)
+        except (IOError, OSError), err:
+            logger.error("Could not store the summary in %s: %s" % (opts.options.summary_filename, err))
+    else:
+        logger.info("Dry run, not actually storing the summary at path %s" % (opts.options.summary_filename))
+        logger.debug("Dry run, summary is %s" % (summary))
+
+    def build_payload(user):
+        # the parts are shared between users, they are merged into a new dict for each user
+        user_queue_information = merge_queue_information(target_queue_parts[user])
+        user_queue_information['timeinfo'] = timeinfo
+        return (user_queue_information, user_map[user])
+
+    store_stats = store_pickle_files(opts.options.location,
+                                     target_users,
+                                     get_pickle_path,
+                                     build_payload,
+                                     lambda user: tuple(target_queue_parts[user]) + (user_map[user],),
+                                     opts.options.store_history_filename,
+                                     opts.options.max_writes_per_second,
+                                     opts.options.max_bytes_per_second,
+                                     opts.options.store_time_budget,
+                                     opts.options.dry_run)
+
+    profiler.report()
+
+    export_state(state_files, opts.options.ha_state_dir, opts.options.dry_run)
 
     logger.info("Finished dshowq")
 
+    nagios_results = dict(hosts=len(reported_hosts),
+                          hosts_critical=len(failed_hosts),
+                          hosts_stale=len(staleinfo),
+                          **store_stats)
+
     #FIXME: this still looks fugly
-    bork_result = NagiosResult("lock release failed",
-                               hosts=len(reported_hosts),
-                               hosts_critical=len(failed_hosts),
-                               stored=nagios_user_count,
-                               stored_critical=nagios_no_store)
+    bork_result = NagiosResult("lock release failed", **nagios_results)
     release_or_bork(lockfile, nagios_reporter, bork_result)
 
-    nagios_reporter.cache(NAGIOS_EXIT_OK,
-                          NagiosResult("run successful",
-                                       hosts=len(reported_hosts),
-                                       hosts_critical=len(failed_hosts),
-                                       stored=nagios_user_count,
-                                       stored_critical=nagios_no_store))
+    nagios_reporter.cache(NAGIOS_EXIT_OK, NagiosResult("run successful", **nagios_results))
 
     sys.exit(0)
 
@@ -30,6 +30,8 @@ import time
 
 from PBSQuery import PBSQuery
 
+from master_scripts.ldap_lookup import ldap_batched_lookup
+from master_scripts.profiler import PROFILE_OPTIONS, RunProfiler
 from vsc.ldap.configuration import VscConfiguration
 from vsc.ldap.entities import VscLdapUser
 from vsc.ldap.filters import LdapFilter
@@ -52,27 +54,37 @@ NAGIOS_CHECK_INTERVAL_THRESHOLD = 60 * 60  # 60 minutes
 
 PBS_CHECK_LOG_FILE = '/var/log/pbs_check_inactive_user_jobs.log'
 
+# LDAP states for which we police the jobs
+USER_STATES = ('grace', 'inactive')
 
-def get_user_with_status(status):
-    """Get the users from the HPC LDAP that match the given status.
 
-    @type ldap: vsc.ldap.utils.LdapQuery instance
-    @type status: string represeting a valid status in the HPC LDAP
+def get_user_states(user_ids, states=USER_STATES):
+    """Build an index of the given users that are in one of the given states in the HPC LDAP.
 
-    @returns: list of VscLdapUser nametuples of matching users.
+    The states are combined in a single query, which is restricted to the given users (in batches, see
+    ldap_batched_lookup), so for the usual number of job owners a single LDAP round-trip suffices.
+
+    @type user_ids: list of strings
+    @type states: list of strings representing valid states in the HPC LDAP
+
+    @returns: dict mapping the uid of each matching user to its status.
     """
-    logger.info("Retrieving users from the HPC LDAP with status=%s." % (status))
+    logger.info("Retrieving users from the HPC LDAP with status in %s." % (list(states)))
+
+    status_filter = reduce(lambda f, g: f | g, [LdapFilter("status=%s" % (status)) for status in states])
 
-    ldap_filter = LdapFilter("status=%s" % (status))
-    users = VscLdapUser.lookup(ldap_filter)
+    user_states = dict([(user.user_id, user.status)
+                        for user in ldap_batched_lookup(VscLdapUser, 'cn', user_ids, status_filter)])
 
-    logger.info("Found %d users in the %s state." % (len(users), status))
-    logger.debug("The following users are in the %s state: %s" % (status, [u.user_id for u in users]))
+    for status in states:
+        uids = [uid for (uid, user_status) in user_states.items() if user_status == status]
+        logger.info("Found %d users in the %s state." % (len(uids), status))
+        logger.debug("The following users are in the %s state: %s" % (status, uids))
 
-    return users
+    return user_states
 
 
-def remove_queued_jobs(jobs, grace_users, inactive_users, dry_run=True):
+def remove_queued_jobs(jobs, user_states, dry_run=True):
     """Determine the queued jobs for users in grace or inactive states.
 
     These jobs are removed if dry_run is False.
@@ -81,18 +93,14 @@ def remove_queued_jobs(jobs, grace_users, inactive_users, dry_run=True):
            sooner than a person becomes inactive, a gracing user might still make
            a succesfull submission that gets started.
     @type jobs: dictionary of all jobs known to PBS, indexed by PBS job name
-    @type grace_users: list of VscLdapUser of users in grace
-    @type inactive_users: list of VscLdapUser of users who are inactive
+    @type user_states: dict mapping uid to status for users in grace or inactive, see get_user_states
 
     @returns: list of jobs that have been removed
     """
-    uids = [u.user_id for u in grace_users]
-    uids.extend([u.user_id for u in inactive_users])
-
     jobs_to_remove = []
     for (job_name, job) in jobs.items():
-        user_id = jobs[job_name]['euser'][0]
-        if user_id in uids:
+        user_id = job['euser'][0]
+        if user_id in user_states:
             jobs_to_remove.append((job_name, job))
 
     logger.info("Found {queued_count} queued jobs belonging to gracing or inactive users".format(queued_count=len(jobs_to_remove)))
@@ -104,11 +112,14 @@ def remove_queued_jobs(jobs, grace_users, inactive_users, dry_run=True):
     return jobs_to_remove
 
 
-def remove_running_jobs(jobs, inactive_users, dry_run=True):
+def remove_running_jobs(jobs, user_states, dry_run=True):
     """Determine the jobs that are currently running that should be removed due to owners being in grace or inactive state.
 
     FIXME: At this point there is no actual removal.
 
+    @type jobs: dictionary of all jobs known to PBS, indexed by PBS job name
+    @type user_states: dict mapping uid to status for users in grace or inactive, see get_user_states
+
     @returns: list of jobs that have been removed.
     """
     return []
@@ -198,6 +209,8 @@ def main(args):
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
     }
+    options.update(PROFILE_OPTIONS)
+
     opts = simple_option(options)
 
     nagios_reporter = NagiosReporter(NAGIOS_HEADER, NAGIOS_CHECK_FILENAME, NAGIOS_CHECK_INTERVAL_THRESHOLD)
@@ -212,24 +225,31 @@ def main(args):
                         NagiosResult("Not running on the HA master."))
         sys.exit(NAGIOS_EXIT_WARNING)
 
-    try:
-        vsc_config = VscConfiguration()
-        LdapQuery(vsc_config)
-
-        grace_users = get_user_with_status('grace')
-        inactive_users = get_user_with_status('inactive')
+    profiler = RunProfiler(NAGIOS_HEADER, opts.options.profile, opts.options.profile_dir, opts.options.profile_keep)
 
+    try:
+        profiler.start('collect')
         pbs_query = PBSQuery()
 
         t = time.ctime()
         jobs = pbs_query.getjobs()  # we just get them all
 
-        removed_queued = remove_queued_jobs(jobs, grace_users, inactive_users, opts.options.dry_run)
-        removed_running = remove_running_jobs(jobs, inactive_users, opts.options.dry_run)
+        # only the owners of the current jobs are of interest
+        profiler.start('ldap')
+        vsc_config = VscConfiguration()
+        LdapQuery(vsc_config)
+
+        user_states = get_user_states([job['euser'][0] for job in jobs.values()])
+
+        profiler.start('transform')
+        removed_queued = remove_queued_jobs(jobs, user_states, opts.options.dry_run)
+        removed_running = remove_running_jobs(jobs, user_states, opts.options.dry_run)
 
         if opts.options.mail_report and not opts.options.dry_run:
             if len(removed_queued) > 0 or len(removed_running) > 0:
                 mail_report(t, removed_queued, removed_running)
+
+        profiler.report()
     except Exception, err:
         logger.exception("Something went wrong: {err}".format(err=err))
         nagios_reporter.cache(NAGIOS_EXIT_CRITICAL,
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 
+import random
 import sys
+import time
 
-
+from master_scripts.ha import HA_OPTIONS, export_state, import_state
+from master_scripts.profiler import PROFILE_OPTIONS, RunProfiler
 from vsc.jobs.moab.internal import MoabCommand
 from vsc.jobs.moab.showq import Showq
 from vsc.utils.availability import proceed_on_ha_service
@@ -28,20 +31,132 @@ RELEASEJOB_LIMITS = {
     # total number of jobs in hold
     'total_warning': 50,
     'total_critical': 100,
-    # per job release attempts (maximum of all jobs)
-    'release_warning': 50,
-    'release_critical': 70,
+    # jobs no longer released automatically
+    'quarantine_warning': 1,
+    'quarantine_critical': 20,
 }
 
+# wait time before releasing a job again doubles with every release, up to the maximum
+RELEASEJOB_BACKOFF_BASE = 10 * 60  # 10 minutes
+RELEASEJOB_BACKOFF_MAX = 12 * 60 * 60  # 12 hours
+RELEASEJOB_BACKOFF_JITTER = 0.25
+# number of releases after which a job is no longer released automatically
+RELEASEJOB_QUARANTINE = 30
+# per job release attempts (maximum of all jobs), as a fraction of the largest number of releases before quarantine
+RELEASEJOB_RELEASE_WARNING = 0.5
+RELEASEJOB_RELEASE_CRITICAL = 0.75
+
 RELEASEJOB_SUPPORTED_HOLDTYPES = ('BatchHold',)
+# holdtype[:max_attempts[:min_age]], comma-separated
+RELEASEJOB_DEFAULT_POLICY = ','.join(RELEASEJOB_SUPPORTED_HOLDTYPES)
+
 
 _log = getLogger(__name__, fname=False)
 logToScreen(True)
 setLogLevelInfo()
 
-def process_hold(clusters, dry_run=False):
-    """Process a filtered queueinfo dict"""
-    releasejob_cache = FileCache(RELEASEJOB_CACHE_FILE)
+def next_release_time(jid, release, released, backoff_base, backoff_max):
+    """Determine when a job that was released before may be released again.
+
+    The wait time doubles with every release, up to backoff_max, and gets a jitter that is fixed
+    per job and release count, so that jobs held at the same time do not all get released together.
+
+    @param jid: the job ID
+    @param release: the number of times the job has been released
+    @param released: the timestamp of the last release
+    @param backoff_base: wait time (in seconds) after the first release
+    @param backoff_max: maximal wait time (in seconds)
+
+    @returns: timestamp after which the job may be released again
+    """
+    if release <= 0:
+        return 0
+
+    wait = min(backoff_base * 2 ** (release - 1), backoff_max)
+    jitter = random.Random("%s-%s" % (jid, release)).uniform(-RELEASEJOB_BACKOFF_JITTER, RELEASEJOB_BACKOFF_JITTER)
+    return released + wait * (1 + jitter)
+
+
+def parse_release_policy(policy, max_attempts, min_age=0):
+    """Parse a release policy.
+
+    @param policy: comma-separated list of holdtype[:max_attempts[:min_age]] entries, e.g., BatchHold:30:600
+    @param max_attempts: number of releases after which a job is no longer released, if not given in the policy
+    @param min_age: time (in seconds) a job must be in hold before it is released, if not given in the policy
+
+    @returns: dict of holdtype -> (max_attempts, min_age)
+    """
+    rules = {}
+    for rule in [r.strip() for r in policy.split(',') if r.strip()]:
+        fields = rule.split(':')
+        if len(fields) > 3:
+            raise ValueError("Invalid release policy rule %s" % (rule))
+        holdtype = fields[0]
+        rule_max_attempts = max_attempts
+        rule_min_age = min_age
+        if len(fields) > 1 and fields[1]:
+            rule_max_attempts = int(fields[1])
+        if len(fields) > 2 and fields[2]:
+            rule_min_age = int(fields[2])
+        rules[holdtype] = (rule_max_attempts, rule_min_age)
+    return rules
+
+
+def compile_release_policies(cluster_policies, default_policy, max_attempts):
+    """Compile the release policies once into an index on cluster and holdtype.
+
+    Looking up the policy for a job is then a constant time operation, regardless of the number of rules.
+
+    @param cluster_policies: dict of cluster -> release policy (or None to use the default policy)
+    @param default_policy: the release policy for clusters that have none of their own
+    @param max_attempts: number of releases after which a job is no longer released, if not given in a policy
+
+    @returns: dict of cluster -> {holdtype -> (max_attempts, min_age)}
+    """
+    default_rules = parse_release_policy(default_policy, max_attempts)
+    policies = {}
+    for cluster, policy in cluster_policies.items():
+        if policy is None:
+            policies[cluster] = default_rules
+        else:
+            policies[cluster] = parse_release_policy(policy, max_attempts)
+        _log.debug("Release policy for cluster %s: %s" % (cluster, policies[cluster]))
+    return policies
+
+
+def release_limits(policies):
+    """Determine the nagios thresholds for the number of releases of a job.
+
+    The thresholds are derived from the largest max_attempts in the policies, so they are reached before the
+    jobs end up in quarantine. Quarantined jobs are not counted in the number of releases, they only trigger the
+    quarantine thresholds.
+
+    @param policies: compiled release policies, as returned by compile_release_policies
+
+    @returns: dict with the release_warning and release_critical thresholds
+    """
+    max_attempts = max([0] + [rule[0] for rules in policies.values() for rule in rules.values()])
+    warning = max(1, int(max_attempts * RELEASEJOB_RELEASE_WARNING))
+    critical = max(warning + 1, int(max_attempts * RELEASEJOB_RELEASE_CRITICAL))
+    return {
+        'release_warning': warning,
+        'release_critical': critical,
+    }
+
+
+def process_hold(clusters, policies, dry_run=False, backoff_base=RELEASEJOB_BACKOFF_BASE,
+                 backoff_max=RELEASEJOB_BACKOFF_MAX, profiler=None, cache_filename=RELEASEJOB_CACHE_FILE):
+    """Process a filtered queueinfo dict
+
+    @param policies: compiled release policies, as returned by compile_release_policies
+    @param profiler: RunProfiler for the phases of the run
+    @param cache_filename: the FileCache with the release history
+    """
+    if profiler is None:
+        profiler = RunProfiler(NAGIOS_HEADER)
+
+    profiler.start('collect')
+    releasejob_cache = FileCache(cache_filename)
 
     # get the showq data
     for hosts, data in clusters.items():
@@ -55,6 +170,8 @@ def process_hold(clusters, dry_run=False):
         data['path'] = data['mpath']  # mjobctl path
     m.clusters = clusters
 
+    profiler.start('transform')
+
     # read the previous data
     ts_data = releasejob_cache.load('queue_information')
     if ts_data is None:
@@ -67,7 +184,11 @@ def process_hold(clusters, dry_run=False):
         'peruser': 0,
         'total': 0,
         'release': 0,
+        'backoff': 0,
+        'minage': 0,
+        'quarantine': 0,
     }
+    now = time.time()
 
     release_jobids = []
 
@@ -76,33 +197,59 @@ def process_hold(clusters, dry_run=False):
         totaluser = 0
         for cluster, data in clusterdata.items():
             olddata = oldclusterdata.setdefault(cluster, {})
+            cluster_policies = policies.get(cluster, {})
             # DRMJID is supposed to be unique
-            # get all oldjobids in one dict
-            oldjobs = dict([(j['DRMJID'], j['_release']) for jt in olddata.values() for j in  jt])
+            # get all oldjobs in one dict
+            oldjobs = dict([(j['DRMJID'], j) for jt in olddata.values() for j in  jt])
             for jobtype, jobs in data.items():
+                policy = cluster_policies.get(jobtype)
                 removeids = []
                 for idx, job in enumerate(jobs):
                     jid = job['DRMJID']
+                    oldjob = oldjobs.get(jid, {})
 
-                    if jobtype in RELEASEJOB_SUPPORTED_HOLDTYPES:
+                    if policy is not None:
+                        (max_attempts, min_age) = policy
                         totaluser += 1
-                        release = max(oldjobs.get(jid, 0), 0) + 1
-                        job['_release'] = release
-                        stats['release'] = max(stats['release'], release)
-                        release_jobids.append(jid)
-                        # release the job
-                        cmd = [m.clusters[cluster]['path'], '-u', jid]
-                        _log.info("Releasing job %s cluster %s for the %s-th time." % (jid, cluster, release))
-                        if dry_run:
-                            _log.info("Dry run %s" % cmd)
+                        release = max(oldjob.get('_release', 0), 0)
+                        released = oldjob.get('_released', 0)
+                        held = oldjob.get('_held', now)
+                        job['_held'] = held
+                        quarantined = release >= max_attempts
+                        if quarantined:
+                            # moab keeps holding this job, leave it to the admins
+                            _log.warning("Job %s cluster %s was released %s times, not releasing it again." %
+                                         (jid, cluster, release))
+                            stats['quarantine'] += 1
+                        elif now - held < min_age:
+                            _log.debug("Job %s cluster %s is in %s for less than %s seconds." %
+                                       (jid, cluster, jobtype, min_age))
+                            stats['minage'] += 1
+                        elif now < next_release_time(jid, release, released, backoff_base, backoff_max):
+                            _log.debug("Job %s cluster %s was released %s times, backing off." % (jid, cluster, release))
+                            stats['backoff'] += 1
                         else:
-                            m._run_moab_command(cmd, cluster, [])
+                            release += 1
+                            released = now
+                            release_jobids.append(jid)
+                            # release the job
+                            cmd = [m.clusters[cluster]['path'], '-u', jid]
+                            _log.info("Releasing job %s cluster %s for the %s-th time." % (jid, cluster, release))
+                            if dry_run:
+                                _log.info("Dry run %s" % cmd)
+                            else:
+                                m._run_moab_command(cmd, cluster, [])
+                        job['_release'] = release
+                        job['_released'] = released
+                        if not quarantined:
+                            # quarantined jobs are reported by the quarantine thresholds only
+                            stats['release'] = max(stats['release'], release)
                     else:
                         # keep historical data, eg a previously released job could be idle now
                         # but keep the counter in case it gets held again
                         try:
-                            release = oldjobs[jid]
-                            job['_release'] = release
+                            job['_release'] = oldjob['_release']
+                            job['_released'] = oldjob.get('_released', 0)
                         except KeyError:
                             # not previously in hold, remove it
                             removeids.append(idx)
@@ -125,11 +272,17 @@ def process_hold(clusters, dry_run=False):
         stats['peruser'] = max(stats['peruser'], totaluser)
         stats['total'] += totaluser
 
-    _log.info("Release statistics: total jobs in hold %(total)s; max in hold per user %(peruser)s; max releases per job %(release)s" % stats)
+    _log.info("Release statistics: total jobs in hold %(total)s; max in hold per user %(peruser)s; max releases per job %(release)s; "
+              "backing off %(backoff)s; too recently held %(minage)s; quarantined %(quarantine)s" % stats)
+
+    profiler.start('store')
 
-    # update and close
-    releasejob_cache.update('queue_information', queue_information, 0)
-    releasejob_cache.close()
+    # update and close, a dry run must not change the release history of the next (real) run
+    if dry_run:
+        _log.info("Dry run, not updating the release history in %s" % (cache_filename))
+    else:
+        releasejob_cache.update('queue_information', queue_information, 0)
+        releasejob_cache.close()
 
     return release_jobids, stats
 
@@ -156,20 +309,36 @@ def main():
         'nagios_check_interval_threshold': ('threshold of nagios checks timing out', None, 'store', NAGIOS_CHECK_INTERVAL_THRESHOLD),
         'hosts': ('the hosts/clusters that should be contacted for job information', None, 'extend', []),
         'location': ('the location for storing the pickle file: gengar, muk', str, 'store', 'gengar'),
+        'backoff_base': ('wait time (in seconds) before releasing a job a second time, doubles with every release',
+                         int, 'store', RELEASEJOB_BACKOFF_BASE),
+        'backoff_max': ('maximal wait time (in seconds) before releasing a job again', int, 'store',
+                        RELEASEJOB_BACKOFF_MAX),
+        'quarantine': ('number of releases after which a job is no longer released, unless the policy says otherwise',
+                       int, 'store', RELEASEJOB_QUARANTINE),
+        'release_policy': ('the holds to release on clusters without a release_policy in the configuration file, as a '
+                           'comma-separated list of holdtype[:max_attempts[:min_age]]', str, 'store',
+                           RELEASEJOB_DEFAULT_POLICY),
+        'cache_filename': ('filename of where the release history is stored', str, 'store', RELEASEJOB_CACHE_FILE),
         'ha': ('high-availability master IP address', None, 'store', None),
         'dry-run': ('do not make any updates whatsoever', None, 'store_true', False),
     }
 
+    options.update(HA_OPTIONS)
+    options.update(PROFILE_OPTIONS)
+
     opts = simple_option(options)
 
     nag = SimpleNagios(_cache=NAGIOS_CHECK_FILENAME)
 
     if opts.options.ha and not proceed_on_ha_service(opts.options.ha):
         _log.info("Not running on the target host in the HA setup. Stopping.")
+        # keep the release history warm, so we can take over without resetting the release counters
+        import_state([opts.options.cache_filename], opts.options.ha_state_dir, opts.options.dry_run)
         nag.ok("Not running on the HA master.")
     else:
         # parse config file
         clusters = {}
+        cluster_policies = {}
         for host in opts.options.hosts:
             master = opts.configfile_parser.get(host, "master")
             showq_path = opts.configfile_parser.get(host, "showq_path")
@@ -179,14 +348,39 @@ def main():
                 'spath': showq_path,
                 'mpath': mjobctl_path,
             }
-
-        # process the new and previous data
-        released_jobids, stats = process_hold(clusters, dry_run=opts.options.dry_run)
-
-        # nagios state
-        stats.update(RELEASEJOB_LIMITS)
-        stats['message'] = "released %s jobs in hold" % len(released_jobids)
-        nag._eval_and_exit(**stats)
+            if opts.configfile_parser.has_option(host, "release_policy"):
+                cluster_policies[host] = opts.configfile_parser.get(host, "release_policy")
+            else:
+                cluster_policies[host] = None
+
+        try:
+            policies = compile_release_policies(cluster_policies, opts.options.release_policy, opts.options.quarantine)
+        except ValueError, err:
+            _log.error("Invalid release policy: %s" % err)
+            policies = None
+            nag.critical("Invalid release policy: %s" % err)
+
+        if policies is not None:
+            # process the new and previous data
+            profiler = RunProfiler(NAGIOS_HEADER, opts.options.profile, opts.options.profile_dir,
+                                   opts.options.profile_keep)
+            released_jobids, stats = process_hold(clusters,
+                                                  policies,
+                                                  dry_run=opts.options.dry_run,
+                                                  backoff_base=opts.options.backoff_base,
+                                                  backoff_max=opts.options.backoff_max,
+                                                  profiler=profiler,
+                                                  cache_filename=opts.options.cache_filename)
+            profiler.report()
+
+            export_state([opts.options.cache_filename], opts.options.ha_state_dir, opts.options.dry_run)
+
+            # nagios state
+            stats.update(RELEASEJOB_LIMITS)
+            stats.update(release_limits(policies))
+            stats['message'] = ("released %s jobs in hold, %s backing off, %s held too recently, %s quarantined" %
+                                (len(released_jobids), stats['backoff'], stats['minage'], stats['quarantine']))
+            nag._eval_and_exit(**stats)
 
     _log.info("Cached nagios state: %s %s" % (nag._final_state[0][1], nag._final_state[1]))
 
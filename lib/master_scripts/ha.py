@@ -0,0 +1,94 @@
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Replication of the state files of the master scripts to the standby HA master.
+"""
+import os
+import shutil
+
+from vsc.utils import fancylogger
+
+# options for simple_option, shared by all scripts that replicate their state files
+HA_OPTIONS = {
+    'ha_state_dir': ('directory shared with the other HA master to replicate the state files', str, 'store', None),
+}
+
+logger = fancylogger.getLogger(__name__)
+
+
+def replicate_state(state_files, state_dir, export=True):
+    """Replicate the state files between this host and the directory shared with the other HA master.
+
+    The HA master exports its state files to the shared directory after each run, the standby imports them
+    so that it can take over with warm caches. Files are only copied when the source is newer than the
+    target, and the target is replaced atomically.
+
+    @type state_files: list of strings
+    @type state_dir: string
+
+    @param state_files: the (local) state files of this script
+    @param state_dir: the directory shared between the HA masters
+    @param export: copy the state files to the shared directory if True, from it if False
+
+    @returns: list of the files that were updated
+    """
+    updated = []
+    for filename in state_files:
+        shared_filename = os.path.join(state_dir, os.path.basename(filename))
+        if export:
+            (source, target) = (filename, shared_filename)
+        else:
+            (source, target) = (shared_filename, filename)
+
+        if not os.path.exists(source):
+            logger.debug("No state file %s to replicate" % (source))
+            continue
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+            continue
+
+        tmp_target = "%s.tmp.%d" % (target, os.getpid())
+        shutil.copy2(source, tmp_target)
+        os.rename(tmp_target, target)
+        updated.append(target)
+
+    logger.info("Replicated %d state files %s %s" % (len(updated), export and "to" or "from", state_dir))
+    return updated
+
+
+def import_state(state_files, state_dir, dry_run=False):
+    """On the standby HA master, keep the state warm, so it can take over without starting from scratch.
+
+    @param state_files: the (local) state files of the script
+    @param state_dir: the directory shared between the HA masters, nothing is replicated if it is None
+    @param dry_run: do not replicate anything
+    """
+    if not state_dir or dry_run:
+        return
+    try:
+        replicate_state(state_files, state_dir, export=False)
+    except (IOError, OSError), err:
+        logger.error("Could not replicate the state from %s: %s" % (state_dir, err))
+
+
+def export_state(state_files, state_dir, dry_run=False):
+    """On the HA master, make the state available to the standby after a run.
+
+    @param state_files: the (local) state files of the script
+    @param state_dir: the directory shared between the HA masters, nothing is replicated if it is None
+    @param dry_run: do not replicate anything
+    """
+    if not state_dir or dry_run:
+        return
+    try:
+        replicate_state(state_files, state_dir, export=True)
+    except (IOError, OSError), err:
+        logger.error("Could not replicate the state to %s: %s" % (state_dir, err))
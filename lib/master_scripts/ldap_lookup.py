@@ -0,0 +1,43 @@
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Batched lookups in the HPC LDAP, shared by the master scripts.
+"""
+from vsc.ldap.filters import LdapFilter
+
+# maximal number of entries we look up in a single LDAP query
+LDAP_LOOKUP_BATCH_SIZE = 1000
+
+
+def ldap_batched_lookup(entity, attribute, values, restriction=None):
+    """Look up the LDAP entries with the given values for the attribute, with a single query per batch of values.
+
+    For the usual number of values (e.g., job owners or projects), a single LDAP round-trip suffices.
+
+    @type entity: VscLdapUser or VscLdapGroup
+    @type attribute: string
+    @type values: list of strings
+    @type restriction: LdapFilter
+
+    @param restriction: filter the entries must also match, e.g., a status
+
+    @return: list of entity instances for the entries that were found.
+    """
+    values = sorted(set(values))
+    found = []
+    for idx in range(0, len(values), LDAP_LOOKUP_BATCH_SIZE):
+        ldap_filter = reduce(lambda f, g: f | g,
+                             [LdapFilter("%s=%s" % (attribute, v)) for v in values[idx:idx + LDAP_LOOKUP_BATCH_SIZE]])
+        if restriction is not None:
+            ldap_filter = restriction & ldap_filter
+        found.extend(entity.lookup(ldap_filter))
+    return found
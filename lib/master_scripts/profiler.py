@@ -0,0 +1,126 @@
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Sampled profiling of the phases of a run of the master scripts.
+"""
+import cProfile
+import os
+import random
+import resource
+import time
+
+from vsc.utils import fancylogger
+
+PROFILE_DIRECTORY = '/var/log/profile'
+PROFILE_KEEP = 10
+
+# options for simple_option, shared by all scripts that use a RunProfiler
+PROFILE_OPTIONS = {
+    'profile': ('profile this fraction of the runs (0 is never, 1 is always)', float, 'store', 0.0),
+    'profile_dir': ('directory where the profiles are stored', str, 'store', PROFILE_DIRECTORY),
+    'profile_keep': ('number of profiled runs for which the profiles are kept', int, 'store', PROFILE_KEEP),
+}
+
+logger = fancylogger.getLogger(__name__)
+
+
+class RunProfiler(object):
+    """Profile the phases of a run, for a sampled fraction of the runs.
+
+    For each phase, the CPU profile is dumped in the profile directory and the elapsed time and the memory
+    use are kept for a summary in the log. The kernel only reports the peak memory use of the whole process,
+    so the summary gives the increase of that peak during the phase and the peak of the run so far. Only the
+    profiles of the most recent runs are kept in the directory.
+    """
+
+    def __init__(self, name, sample=0.0, directory=None, keep=0):
+        """Initialise.
+
+        @type name: string
+        @type sample: float
+        @type directory: string
+        @type keep: int
+
+        @param name: the name of the script, used as a prefix for the profile files
+        @param sample: fraction of the runs that should be profiled, 0 never profiles, 1 always profiles
+        @param directory: where the profile files are dumped
+        @param keep: the number of runs for which the profile files are kept, 0 keeps all of them
+        """
+        self.name = name
+        self.directory = directory
+        self.keep = keep
+        self.enabled = sample > 0 and random.random() < sample
+        self.run = "%s.%s.%d" % (name, time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self.current = None
+        self.summary = []
+
+        if self.enabled and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, err:
+                self.disable("Could not create the profile directory %s: %s" % (directory, err))
+
+    def start(self, phase):
+        """Start profiling the given phase, this ends the current phase (if any)."""
+        if not self.enabled:
+            return
+
+        self.stop()
+        profile = cProfile.Profile()
+        self.current = (phase, time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, profile)
+        profile.enable()
+
+    def stop(self):
+        """End the current phase (if any) and dump its profile."""
+        if not self.enabled or self.current is None:
+            return
+
+        (phase, start, start_peak, profile) = self.current
+        profile.disable()
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.current = None
+        try:
+            profile.dump_stats(os.path.join(self.directory, "%s.%s.prof" % (self.run, phase)))
+        except (IOError, OSError), err:
+            self.disable("Could not store the profile of phase %s: %s" % (phase, err))
+            return
+        self.summary.append((phase, elapsed, peak - start_peak, peak))
+
+    def disable(self, reason):
+        """Stop profiling for the rest of the run, a failing profiler must not break the run itself."""
+        logger.error("%s, profiling is disabled for run %s" % (reason, self.run))
+        if self.current is not None:
+            self.current[-1].disable()
+            self.current = None
+        self.enabled = False
+
+    def report(self):
+        """Log a summary of the profiled phases and remove the profiles of older runs."""
+        if not self.enabled:
+            return
+
+        self.stop()
+        for (phase, elapsed, growth, peak) in self.summary:
+            logger.info("Profile %s: phase %s took %.2f s, peak memory grew by %d KiB (process peak so far %d KiB)" %
+                        (self.run, phase, elapsed, growth, peak))
+
+        if self.keep and self.enabled:
+            try:
+                runs = sorted(set([f.rsplit('.', 2)[0] for f in os.listdir(self.directory)
+                                   if f.startswith("%s." % (self.name)) and f.endswith(".prof")]))
+                for run in runs[:-self.keep]:
+                    for f in os.listdir(self.directory):
+                        if f.startswith("%s." % (run)):
+                            os.unlink(os.path.join(self.directory, f))
+            except OSError, err:
+                self.disable("Could not remove the profiles of older runs from %s: %s" % (self.directory, err))
@@ -0,0 +1,366 @@
+##
+#
+# Copyright 2013-2013 Ghent University
+#
+# This file is part of the tools originally by the HPC team of
+# Ghent University (http://ugent.be/hpc).
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+##
+"""
+Helpers for the scripts that collect Moab information and store it in the users' pickle directories
+(dshowq, dcheckjob).
+"""
+import cPickle
+import hashlib
+import json
+import os
+import random
+import time
+
+from vsc.administration.user import cluster_user_pickle_store_map
+from vsc.utils import fancylogger
+from vsc.utils.cache import FileCache
+from vsc.utils.fs_store import UserStorageError, FileStoreError, FileMoveError
+
+logger = fancylogger.getLogger(__name__)
+
+
+def merge_last_good_snapshots(information, reported_hosts, failed_hosts, snapshot_filename, max_age,
+                              dry_run=False):
+    """Keep the last successful result for each host and use it for the hosts that failed in this run.
+
+    @type information: dict of user -> {cluster -> job information}
+    @type reported_hosts: list of strings
+    @type failed_hosts: list of strings
+    @type snapshot_filename: string
+    @type max_age: int
+
+    @param information: the information as returned by the Moab command, this is updated in place
+    @param reported_hosts: the hosts that gave us information in this run
+    @param failed_hosts: the hosts that could not be contacted in this run
+    @param snapshot_filename: the FileCache holding the last good information for each host
+    @param max_age: the maximal age (in seconds) of a snapshot before we no longer use it
+    @param dry_run: do not update the snapshot file
+
+    @returns: dict mapping each host for which we used an older snapshot to the timestamp of that snapshot.
+    """
+    now = time.time()
+    snapshots = FileCache(snapshot_filename)
+
+    for host in reported_hosts:
+        host_information = dict([(user, clusterdata[host]) for (user, clusterdata) in information.items()
+                                 if host in clusterdata])
+        snapshots.update(host, (now, host_information), 0)
+
+    stale_hosts = {}
+    for host in failed_hosts:
+        snapshot = snapshots.load(host)
+        if snapshot is None:
+            logger.warning("No previous snapshot available for failed host %s" % (host))
+            continue
+
+        (_, (timestamp, host_information)) = snapshot
+        if now - timestamp > max_age:
+            logger.warning("Snapshot for failed host %s is too old (%d seconds), not using it" % (host, now - timestamp))
+            continue
+
+        logger.info("Using snapshot from %s for failed host %s" % (time.ctime(timestamp), host))
+        for (user, data) in host_information.items():
+            information.setdefault(user, {})[host] = data
+        stale_hosts[host] = timestamp
+        # retain the snapshot with its original timestamp
+        snapshots.update(host, (timestamp, host_information), 0)
+
+    if not dry_run:
+        snapshots.close()
+
+    return stale_hosts
+
+
+def store_json(filename, data):
+    """Atomically replace the file with the JSON representation of data, so readers never see a partial file."""
+    tmp_filename = "%s.tmp.%d" % (filename, os.getpid())
+    fp = open(tmp_filename, 'w')
+    try:
+        json.dump(data, fp)
+    finally:
+        fp.close()
+    os.chmod(tmp_filename, 0644)
+    os.rename(tmp_filename, filename)
+
+
+def schedule_pickle_stores(get_pickle_path, location, users):
+    """Determine the order in which the pickle files for the given users should be stored.
+
+    On GPFS the metadata operations dominate the cost of storing the files, so we group the stores
+    by the directory that holds the users' pickle directories (i.e., the fileset) and handle each
+    group in one go instead of jumping between filesets in arbitrary order. Each file is still
+    stored (and atomically replaced) individually by the store function for the location.
+
+    @type get_pickle_path: function
+    @type location: string
+    @type users: list of strings
+
+    @param get_pickle_path: the script's function mapping (location, user) to (path, store function)
+    @param location: indication of the user accesible storage spot to use, e.g., home or scratch
+    @param users: VSC user IDs
+
+    @returns: tuple of (sorted list of (directory, sorted list of (user, path)) tuples,
+                        list of users for which the path could not be determined).
+    """
+    groups = {}
+    unresolved = []
+    for user in users:
+        try:
+            (path, _) = get_pickle_path(location, user)
+        except (UserStorageError, FileStoreError, FileMoveError), err:
+            logger.error("Could not determine pickle path for user %s: %s" % (user, err))
+            unresolved.append(user)
+            continue
+        directory = os.path.dirname(os.path.dirname(path))
+        groups.setdefault(directory, []).append((user, path))
+
+    return ([(directory, sorted(groups[directory])) for directory in sorted(groups)], unresolved)
+
+
+class StoreThrottle(object):
+    """Keep the rate at which pickle files are stored below a maximal number of files and bytes per second."""
+
+    def __init__(self, max_writes_per_second=0, max_bytes_per_second=0):
+        """Initialise.
+
+        @type max_writes_per_second: int
+        @type max_bytes_per_second: int
+
+        @param max_writes_per_second: maximal number of files stored per second, 0 means unlimited
+        @param max_bytes_per_second: maximal number of bytes stored per second, 0 means unlimited
+        """
+        self.max_writes_per_second = max_writes_per_second
+        self.max_bytes_per_second = max_bytes_per_second
+        self.start = time.time()
+        self.writes = 0
+        self.bytes = 0
+        self.throttled = 0.0
+
+    def wait(self, size):
+        """Wait until storing another file of the given size stays within the budget."""
+        self.writes += 1
+        self.bytes += size
+
+        earliest = 0.0
+        if self.max_writes_per_second:
+            earliest = max(earliest, float(self.writes - 1) / self.max_writes_per_second)
+        if self.max_bytes_per_second:
+            earliest = max(earliest, float(self.bytes - size) / self.max_bytes_per_second)
+
+        delay = earliest - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+            self.throttled += delay
+
+
+def digest_pickle_contents(contents):
+    """Serialise the information for each user, to determine its digest and size.
+
+    Information that is shared by several users (e.g., the information of a VO or a project) is only
+    serialised once: a tuple is digested per element, so the elements it shares with the information of other
+    users are only serialised once, anything else is identified by the object itself.
+
+    @type contents: dict of user -> information that will be stored for that user
+
+    @returns: dict of user -> (digest, size in bytes)
+    """
+    seen = {}
+
+    def digest_part(part):
+        key = id(part)
+        if key not in seen:
+            data = cPickle.dumps(part)
+            seen[key] = (hashlib.md5(data).hexdigest(), len(data))
+        return seen[key]
+
+    digests = {}
+    for (user, content) in contents.items():
+        if isinstance(content, tuple):
+            part_digests = [digest_part(part) for part in content]
+            digests[user] = (hashlib.md5("".join([d for (d, _) in part_digests])).hexdigest(),
+                             sum([size for (_, size) in part_digests]))
+        else:
+            digests[user] = digest_part(content)
+    return digests
+
+
+def prioritise_pickle_stores(digests, history, max_writes=0, max_bytes=0):
+    """Determine for which users the pickle file can be stored within the I/O budget of this run.
+
+    Users whose information changed since it was last stored go first, those that have been waiting the
+    longest for their change to be stored before the others. Users without changes follow, the ones that
+    were stored the longest ago first. Ties are broken at random, so no user is always last. The users that
+    do not fit within the budget are deferred to the next run.
+
+    The history only records the digest of what was actually stored, the caller updates it with
+    record_pickle_store for each user whose pickle file was stored.
+
+    @type digests: dict of user -> (digest, size in bytes) of the information that will be stored for that user
+    @type history: dict of user -> (digest, timestamp of the store, timestamp since which a change is pending)
+    @type max_writes: int
+    @type max_bytes: int
+
+    @param max_writes: maximal number of files to store in this run, 0 means unlimited
+    @param max_bytes: maximal number of bytes to store in this run, 0 means unlimited
+
+    @returns: tuple of (dict of selected user -> estimated size in bytes,
+                        list of deferred users,
+                        dict of user -> (digest, timestamp of the store, timestamp of the pending change) with
+                        the pending changes of this run)
+    """
+    now = time.time()
+    candidates = []
+    new_history = {}
+    for (user, (digest, size)) in digests.items():
+        entry = history.get(user)
+        if entry is None or len(entry) != 3:
+            # never stored, or recorded in the format of an older version
+            entry = (None, 0, None)
+        (stored_digest, stored, pending) = entry
+        if digest != stored_digest:
+            if pending is None:
+                pending = now
+            candidates.append(((0, pending), user, size))
+        else:
+            pending = None
+            candidates.append(((1, stored), user, size))
+        new_history[user] = (stored_digest, stored, pending)
+
+    random.shuffle(candidates)
+    candidates.sort(key=lambda c: c[0])  # stable, so equal priorities stay in random order
+
+    selected = {}
+    deferred = []
+    total_bytes = 0
+    for (_, user, size) in candidates:
+        if (max_writes and len(selected) >= max_writes) or (max_bytes and total_bytes + size > max_bytes):
+            deferred.append(user)
+        else:
+            selected[user] = size
+            total_bytes += size
+
+    return (selected, deferred, new_history)
+
+
+def record_pickle_store(history, user, digest):
+    """Record in the history that the information with the given digest was stored for the user."""
+    history[user] = (digest, time.time(), None)
+
+
+def store_pickle_files(locations, users, get_pickle_path, build_payload, digest_content, history_filename,
+                       max_writes_per_second=0, max_bytes_per_second=0, time_budget=0, dry_run=False):
+    """Store the pickle file of each user in each of the locations, within the I/O budget of the run.
+
+    The digests and sizes are computed once and shared by all locations, which only need them when the I/O
+    budget or the byte rate is limited; each location's store function still pickles its own copy of the
+    payload.
+
+    @type locations: list of strings
+    @type users: list of strings
+    @type get_pickle_path: function
+    @type build_payload: function
+    @type digest_content: function
+    @type history_filename: string
+
+    @param locations: the user accessible storage spots to store the pickle files in, e.g., home or scratch
+    @param users: VSC user IDs
+    @param get_pickle_path: the script's function mapping (location, user) to (path, store function)
+    @param build_payload: function mapping a user to the information that is stored in the user's pickle file
+    @param digest_content: function mapping a user to the part of the payload that identifies a change, i.e.,
+                           without the timestamps of the run
+    @param history_filename: the FileCache with the store history of each location
+    @param max_writes_per_second: maximal number of files stored per second, 0 means unlimited
+    @param max_bytes_per_second: maximal number of bytes stored per second, 0 means unlimited
+    @param time_budget: the time (in seconds) the stores may take in each location, 0 means unlimited
+    @param dry_run: do not store anything
+
+    @returns: dict with the number of users that were stored, failed (stored_critical), deferred and the time
+              the stores were throttled, summed over the locations, and the failures per location
+              (stored_critical_<location>).
+    """
+    use_budget = time_budget and (max_writes_per_second or max_bytes_per_second)
+    digests = None
+    if use_budget or max_bytes_per_second:
+        digests = digest_pickle_contents(dict([(user, digest_content(user)) for user in users]))
+    if use_budget:
+        store_history = FileCache(history_filename)
+
+    stats = {
+        'stored': 0,
+        'stored_critical': 0,
+        'deferred': 0,
+        'throttled': 0.0,
+    }
+    for location in locations:
+        if use_budget:
+            # only store what fits in the I/O budget, the users that have been waiting longest for a change go first
+            history = store_history.load(location)
+            if history is None:
+                history = {}
+            else:
+                history = history[1]
+            (store_sizes, deferred, history) = prioritise_pickle_stores(digests,
+                                                                        history,
+                                                                        max_writes_per_second * time_budget,
+                                                                        max_bytes_per_second * time_budget)
+        elif digests is not None:
+            store_sizes = dict([(user, size) for (user, (_, size)) in digests.items()])
+            deferred = []
+        else:
+            store_sizes = dict([(user, 0) for user in users])
+            deferred = []
+        if deferred:
+            logger.warning("I/O budget exceeded for location %s, deferring the store for %d users to the next run" %
+                           (location, len(deferred)))
+            logger.debug("Deferred users for location %s: %s" % (location, deferred))
+        throttle = StoreThrottle(max_writes_per_second, max_bytes_per_second)
+
+        store = cluster_user_pickle_store_map[location]
+        (store_schedule, unresolved_users) = schedule_pickle_stores(get_pickle_path, location, store_sizes.keys())
+        stored = 0
+        failed = len(unresolved_users)
+
+        for (directory, user_paths) in store_schedule:
+            logger.debug("Storing pickle files for %d users under %s" % (len(user_paths), directory))
+            for (user, path) in user_paths:
+                if not dry_run:
+                    throttle.wait(store_sizes[user])
+                    try:
+                        store(user, path, build_payload(user))
+                        stored += 1
+                        if use_budget:
+                            record_pickle_store(history, user, digests[user][0])
+                    except (UserStorageError, FileStoreError, FileMoveError), err:
+                        logger.error("Could not store pickle file for user %s at location %s: %s" %
+                                     (user, location, err))
+                        failed += 1
+                else:
+                    logger.info("Dry run, not actually storing data for user %s at path %s" % (user, path))
+                    logger.debug("Dry run, information for user %s is %s" % (user, build_payload(user)))
+
+        if throttle.throttled:
+            logger.info("Throttled the stores for location %s for %.1f seconds" % (location, throttle.throttled))
+        logger.info("Stored %d pickle files at location %s, %d failed" % (stored, location, failed))
+
+        stats['stored'] += stored
+        stats['stored_critical'] += failed
+        stats['stored_critical_%s' % (location)] = failed
+        stats['deferred'] += len(deferred)
+        stats['throttled'] += throttle.throttled
+        if use_budget and not dry_run:
+            store_history.update(location, history, 0)
+
+    if use_budget and not dry_run:
+        store_history.close()
+
+    stats['throttled'] = int(stats['throttled'])
+    return stats
@@ -34,7 +34,8 @@ PACKAGE = {
     'author': [ag, kh, sdw, wdp],
     'description': 'UGent HPC scripts that should be deployed on the masters',
     'license': 'LGPL',
-    'package_dir': '',
+    'package_dir': {'': 'lib'},
+    'packages': ['master_scripts'],
     'scripts': [
         'bin/dcheckjob.py',
         'bin/dshowq.py',